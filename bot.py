@@ -9,10 +9,14 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 from aiogram.types import ReplyKeyboardRemove, KeyboardButton, FSInputFile, InlineKeyboardMarkup, ReplyKeyboardMarkup
-from database import User, Product, get_session # ИСПРАВЛЕНО: импортируем get_session
+from database import User, get_session # ИСПРАВЛЕНО: импортируем get_session
 from sqlalchemy.orm import Session as SessionType # Оставляем для аннотации типов, если нужно
 from sqlalchemy.orm.attributes import flag_modified
 from keyboards import main_menu # Убедись, что keyboards.py корректно определен
+from promotions import get_promotion_plan
+from orders import create_order, list_user_orders
+from catalog_cache import catalog_cache
+from fsm_storage import BoundedMemoryStorage
 
 # Добавляем путь к текущей директории для импортов
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -33,12 +37,21 @@ try:
         raise ValueError("BOT_TOKEN is not set in .env file.")
 
     bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher()
+    # Состояния FSM хранятся в памяти с ограничением по числу пользователей и времени простоя
+    dp = Dispatcher(storage=BoundedMemoryStorage(
+        max_entries=int(os.getenv("FSM_MAX_ENTRIES", "100000")),
+        idle_ttl=float(os.getenv("FSM_IDLE_TTL", str(24 * 60 * 60))),
+    ))
     logging.info("Bot and Dispatcher initialized successfully.")
 
     ADMIN_ID = os.getenv("ADMIN_ID")
     if not ADMIN_ID:
         logging.warning("ADMIN_ID environment variable is not set. Admin notifications will not work.")
+
+    # Снимок производного состояния для быстрого старта после деплоя
+    SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "warm_snapshot.json"))
+    # Сколько секунд ждать завершения обрабатываемых обновлений при остановке
+    DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "25"))
 except Exception as e:
     logging.critical(f"FATAL ERROR during Bot/Dispatcher initialization: {e}", exc_info=True)
     sys.exit(1)
@@ -113,6 +126,44 @@ async def edit_or_send_message(callback: types.CallbackQuery, text: str = None,
             logging.error(f"Failed to send new message after edit failure: {send_e}")
             return None
 
+# Загружает товары корзины (из кэша каталога, недостающие - одним запросом) и возвращает пары (product, quantity)
+def load_cart_lines(session: SessionType, cart: list):
+    products = catalog_cache.get_products(session, list({item["product_id"] for item in cart}))
+    return [(products.get(item["product_id"]), item["quantity"]) for item in cart]
+
+# Считает корзину с учетом активных акций
+def price_cart(session: SessionType, cart: list):
+    return get_promotion_plan(session).evaluate(load_cart_lines(session, cart))
+
+# Обновления, которые сейчас обрабатываются; дожидаемся их при остановке
+in_flight_updates = set()
+
+@dp.update.outer_middleware()
+async def track_in_flight_middleware(handler, event, data):
+    task = asyncio.current_task()
+    in_flight_updates.add(task)
+    try:
+        return await handler(event, data)
+    finally:
+        in_flight_updates.discard(task)
+
+@dp.startup()
+async def on_startup(bot: Bot):
+    catalog_cache.load(SNAPSHOT_PATH, bot_id=bot.id)
+
+@dp.shutdown()
+async def on_shutdown(bot: Bot):
+    pending = in_flight_updates - {asyncio.current_task()}
+    if pending:
+        logging.info(f"Waiting for {len(pending)} in-flight updates to finish...")
+        _, still_running = await asyncio.wait(pending, timeout=DRAIN_TIMEOUT)
+        if still_running:
+            logging.warning(f"{len(still_running)} updates did not finish within {DRAIN_TIMEOUT}s.")
+    try:
+        catalog_cache.save(SNAPSHOT_PATH, bot_id=bot.id)
+    except Exception as e:
+        logging.error(f"Failed to save warm-start snapshot: {e}")
+
 # Middleware для управления сессиями базы данных
 @dp.update.middleware()
 async def db_session_middleware(handler, event, data):
@@ -172,10 +223,15 @@ async def feed_type_menu(callback: types.CallbackQuery, state: FSMContext):
 
 # Обработчик кнопки "Акции"
 @dp.callback_query(F.data == "menu:promo")
-async def promo_menu(callback: types.CallbackQuery, state: FSMContext):
+async def promo_menu(callback: types.CallbackQuery, state: FSMContext, session: SessionType):
     builder = InlineKeyboardBuilder()
     builder.add(types.InlineKeyboardButton(text="В главное меню", callback_data="menu:main"))
-    await edit_or_send_message(callback, text="Акция: Возьмите 10 пачек и одну получите бонусом!", reply_markup=builder.as_markup())
+    live_rules = get_promotion_plan(session).live_rules()
+    if live_rules:
+        text = "Акции:\n" + "\n".join(f"🎁 {rule.name}" for rule in live_rules)
+    else:
+        text = "Сейчас активных акций нет."
+    await edit_or_send_message(callback, text=text, reply_markup=builder.as_markup())
     await callback.answer()
     await state.set_state(UserState.MAIN_MENU)
 
@@ -190,31 +246,34 @@ async def show_cart_with_session(callback: types.CallbackQuery, state: FSMContex
         await state.set_state(UserState.IN_CART)
         return
     
-    total = 0
+    pricing = price_cart(session, user.cart)
     text = "🛒 Ваша корзина:\n\n"
     cart_items_builder = InlineKeyboardBuilder()
     
-    for i, item in enumerate(user.cart):
-        product = session.query(Product).filter_by(id=item["product_id"]).first()
+    for line in pricing.lines:
+        i, product = line.index, line.product
         if product:
-            item_total_price = product.price * item['quantity']
-            total += item_total_price
             text += f"{i+1}. {product.name}\n"
-            text += f"    Количество: {item['quantity']} шт. | Цена за шт.: {product.price} руб.\n"
-            text += f"    Общая цена: {item_total_price} руб.\n\n"
+            text += f"    Количество: {line.quantity} шт. | Цена за шт.: {product.price} руб.\n"
+            if line.discount:
+                text += f"    Скидка ({line.rule_name}): -{line.discount} руб.\n"
+            text += f"    Общая цена: {line.total} руб.\n\n"
             cart_items_builder.row(
                 types.InlineKeyboardButton(text=f"➖", callback_data=f"cart_item:remove_one:{i}"),
                 types.InlineKeyboardButton(text=f"🗑️", callback_data=f"cart_item:delete_all:{i}"),
                 types.InlineKeyboardButton(text=f"➕", callback_data=f"cart_item:add_one:{i}")
             )
         else:
-            text += f"{i+1}. Неизвестный товар (ID: {item['product_id']})\n"
-            text += f"    Количество: {item['quantity']} шт.\n\n"
+            text += f"{i+1}. Неизвестный товар (ID: {user.cart[i]['product_id']})\n"
+            text += f"    Количество: {line.quantity} шт.\n\n"
             cart_items_builder.row(
                 types.InlineKeyboardButton(text=f"🗑️ Удалить неизвестный", callback_data=f"cart_item:delete_all:{i}")
             )
     
-    text += f"💵 Итого: {total} руб."
+    if pricing.discount:
+        text += f"Сумма без скидки: {pricing.subtotal} руб.\n"
+        text += f"🎁 Скидка: -{pricing.discount} руб.\n"
+    text += f"💵 Итого: {pricing.total} руб."
     
     main_cart_buttons_builder = InlineKeyboardBuilder()
     main_cart_buttons_builder.add(
@@ -282,36 +341,30 @@ async def delete_all_from_cart_item(callback: types.CallbackQuery, state: FSMCon
     else:
         await callback.answer("Ошибка: Товар не найден в корзине.", show_alert=True)
 
+# Клавиатура со списком товаров категории (строится один раз на версию каталога)
+def category_menu_markup(session: SessionType, category: str) -> InlineKeyboardMarkup:
+    def build():
+        builder = InlineKeyboardBuilder()
+        for product in catalog_cache.products_in_category(session, category):
+            builder.add(types.InlineKeyboardButton(text=product.name, callback_data=f"product:{product.id}"))
+        builder.adjust(1)
+        builder.row(
+            types.InlineKeyboardButton(text="Назад", callback_data="menu:feed_type"),
+            types.InlineKeyboardButton(text="В главное меню", callback_data="menu:main"),
+        )
+        return builder.as_markup()
+    return catalog_cache.markup(session, f"category:{category}", build)
+
 # Меню выбора корма для кошек
 @dp.callback_query(F.data == "feed:cats")
 async def cats_menu(callback: types.CallbackQuery, session: SessionType):
-    builder = InlineKeyboardBuilder()
-    # Получаем продукты для кошек из базы данных
-    cat_products = session.query(Product).filter_by(category="cats").all()
-    for product in cat_products:
-        builder.add(types.InlineKeyboardButton(text=product.name, callback_data=f"product:{product.id}"))
-    builder.adjust(1)
-    builder.row(
-        types.InlineKeyboardButton(text="Назад", callback_data="menu:feed_type"),
-        types.InlineKeyboardButton(text="В главное меню", callback_data="menu:main"),
-    )
-    await edit_or_send_message(callback, text="Выберите корм для кошек:", reply_markup=builder.as_markup())
+    await edit_or_send_message(callback, text="Выберите корм для кошек:", reply_markup=category_menu_markup(session, "cats"))
     await callback.answer()
 
 # Меню выбора корма для собак
 @dp.callback_query(F.data == "feed:dogs")
 async def dogs_menu(callback: types.CallbackQuery, session: SessionType):
-    builder = InlineKeyboardBuilder()
-    # Получаем продукты для собак из базы данных
-    dog_products = session.query(Product).filter_by(category="dogs").all()
-    for product in dog_products:
-        builder.add(types.InlineKeyboardButton(text=product.name, callback_data=f"product:{product.id}"))
-    builder.adjust(1)
-    builder.row(
-        types.InlineKeyboardButton(text="Назад", callback_data="menu:feed_type"),
-        types.InlineKeyboardButton(text="В главное меню", callback_data="menu:main"),
-    )
-    await edit_or_send_message(callback, text="Выберите корм для собак:", reply_markup=builder.as_markup())
+    await edit_or_send_message(callback, text="Выберите корм для собак:", reply_markup=category_menu_markup(session, "dogs"))
     await callback.answer()
 
 # Вспомогательная функция для отображения продукта по ID
@@ -319,7 +372,7 @@ async def show_product_by_id(callback: types.CallbackQuery, state: FSMContext, s
     await callback.answer()
     logging.info(f"show_product_by_id: START. product_id received: {product_id}")
     
-    product = session.query(Product).filter_by(id=product_id).first()
+    product = catalog_cache.get_product(session, product_id)
     
     if not product:
         logging.error(f"show_product_by_id: Product with ID {product_id} not found.")
@@ -334,8 +387,14 @@ async def show_product_by_id(callback: types.CallbackQuery, state: FSMContext, s
     else:
         back_callback = "menu:main" # Запасной вариант
 
-    image_path = os.path.join("/app/images", product.image_path)
-    if not os.path.exists(image_path):
+    # Товары из фида поставщика могут прийти без картинки
+    image_path = os.path.join("/app/images", product.image_path) if product.image_path else None
+    # Фото, уже загруженное в Telegram, отправляем по file_id без повторной загрузки
+    file_id = catalog_cache.photo_for(image_path) if image_path else None
+    if file_id:
+        photo = file_id
+        image_warning = ""
+    elif not image_path or not os.path.exists(image_path):
         logging.warning(f"Image file not found: {image_path}. Using placeholder.")
         photo = None
         image_warning = "\n\n(Изображение не найдено)"
@@ -343,24 +402,41 @@ async def show_product_by_id(callback: types.CallbackQuery, state: FSMContext, s
         photo = FSInputFile(image_path)
         image_warning = ""
 
-    builder = InlineKeyboardBuilder()
-    builder.add(
-        types.InlineKeyboardButton(
-            text="Добавить в корзину",
-            callback_data=f"cart:add:{product.id}" # Передаем только ID продукта
-        ),
-    )
-    builder.row(
-        types.InlineKeyboardButton(text="Назад", callback_data=f"back:{back_callback}"),
-        types.InlineKeyboardButton(text="В главное меню", callback_data="menu:main"),
-    )
+    def build():
+        builder = InlineKeyboardBuilder()
+        builder.add(
+            types.InlineKeyboardButton(
+                text="Добавить в корзину",
+                callback_data=f"cart:add:{product.id}" # Передаем только ID продукта
+            ),
+        )
+        builder.row(
+            types.InlineKeyboardButton(text="Назад", callback_data=f"back:{back_callback}"),
+            types.InlineKeyboardButton(text="В главное меню", callback_data="menu:main"),
+        )
+        return builder.as_markup()
     
-    await edit_or_send_message(
-        callback,
-        photo=photo,
-        text=f"<b>{product.name}</b>\n{product.description}\nЦена: {product.price} руб.{image_warning}",
-        reply_markup=builder.as_markup()
-    )
+    async def send(photo, image_warning):
+        return await edit_or_send_message(
+            callback,
+            photo=photo,
+            text=f"<b>{product.name}</b>\n{product.description}\nЦена: {product.price} руб.{image_warning}",
+            reply_markup=catalog_cache.markup(session, f"product:{product.id}", build)
+        )
+
+    new_message = await send(photo, image_warning)
+    if new_message is None and file_id:
+        # Telegram не принял сохраненный file_id (например, после смены бота) - забываем его и загружаем файл заново
+        logging.warning(f"Cached photo file_id for {image_path} was rejected, uploading the file again.")
+        catalog_cache.forget_photo(image_path)
+        if os.path.exists(image_path):
+            photo = FSInputFile(image_path)
+            new_message = await send(photo, "")
+        else:
+            photo = None
+            new_message = await send(photo, "\n\n(Изображение не найдено)")
+    if isinstance(photo, FSInputFile) and isinstance(new_message, types.Message) and new_message.photo:
+        catalog_cache.remember_photo(image_path, new_message.photo[-1].file_id)
 
 # Универсальный обработчик для всех товаров (кошки и собаки)
 @dp.callback_query(F.data.startswith("product:"))
@@ -398,8 +474,8 @@ async def add_to_cart(callback: types.CallbackQuery, state: FSMContext, session:
         user = User(id=user_id, cart=[], state=UserState.MAIN_MENU.state)
         session.add(user)
 
-    product = session.query(Product).filter_by(id=product_id).first()
-    logging.info(f"Product fetched from DB in add_to_cart: {product}")
+    product = catalog_cache.get_product(session, product_id)
+    logging.info(f"Product fetched in add_to_cart: {product}")
 
     if not product:
         logging.error(f"Product with ID {product_id} NOT found in database when adding to cart.")
@@ -473,7 +549,7 @@ async def handle_non_contact_in_order(message: types.Message, state: FSMContext)
 
 # Обработка отправленного контакта и завершение заказа
 @dp.message(OrderStates.waiting_for_contact, F.contact)
-async def process_contact(message: types.Message, state: FSMContext, session: SessionType):
+async def process_contact(message: types.Message, state: FSMContext, session: SessionType, event_update: types.Update):
     try:
         await message.delete() 
     except Exception as e:
@@ -482,35 +558,60 @@ async def process_contact(message: types.Message, state: FSMContext, session: Se
     data = await state.get_data()
     user = session.query(User).filter_by(id=message.from_user.id).first()
     cart_items = user.cart if user else []
+    pricing = price_cart(session, cart_items)
+    if not pricing.lines:
+        # Корзину очистили, пока оформлялся заказ - сохранять нечего
+        await state.clear()
+        await message.answer("Ваша корзина пуста! Нечего оформлять.", reply_markup=ReplyKeyboardRemove())
+        builder = InlineKeyboardBuilder()
+        builder.row(types.InlineKeyboardButton(text="В главное меню", callback_data="menu:main"))
+        await message.answer("Корзина пуста!", reply_markup=builder.as_markup())
+        await state.set_state(UserState.IN_CART)
+        return
+    order, created = create_order(
+        session,
+        update_id=event_update.update_id,
+        user_id=message.from_user.id,
+        cart=cart_items,
+        pricing=pricing,
+        address=data.get("address"),
+        phone=message.contact.phone_number,
+    )
+    if not created:
+        # Повторная доставка того же update - заказ уже оформлен
+        await state.clear()
+        return
     cart_text = ""
-    total = 0
-    for item in cart_items:
-        product = session.query(Product).filter_by(id=item["product_id"]).first()
-        if product:
-            cart_text += f"- {product.name} ({item['quantity']} шт.) - {product.price * item['quantity']} руб.\n"
-            total += product.price * item["quantity"]
+    for line in pricing.lines:
+        if line.product:
+            cart_text += f"- {line.product.name} ({line.quantity} шт.) - {line.total} руб.\n"
+            if line.discount:
+                cart_text += f"  🎁 {line.rule_name}: -{line.discount} руб. (без скидки {line.subtotal} руб.)\n"
         else:
-            cart_text += f"- Неизвестный товар (ID: {item['product_id']}) - {item['quantity']} шт.\n"
+            cart_text += f"- Неизвестный товар (ID: {cart_items[line.index]['product_id']}) - {line.quantity} шт.\n"
+    discount_text = f"🎁 Скидка: -{pricing.discount} руб.\n" if pricing.discount else ""
 
     if ADMIN_ID:
         try:
             await bot.send_message(
                 ADMIN_ID,
-                f"🔥 Новый заказ!\n"
+                f"🔥 Новый заказ №{order.id}!\n"
                 f"👤 Пользователь: @{message.from_user.username if message.from_user.username else message.from_user.full_name} (ID: {message.from_user.id})\n"
                 f"📦 Адрес: {data['address']}\n"
                 f"📱 Контакт: {message.contact.phone_number}\n"
                 f"🛒 Корзина:\n{cart_text}\n"
-                f"💵 Итого: {total} руб."
+                f"{discount_text}"
+                f"💵 Итого: {pricing.total} руб."
             )
         except Exception as e:
             logging.error(f"Failed to send order message to admin: {e}")
+            session.rollback()
             await message.answer("Произошла ошибка при оформлении заказа. Пожалуйста, попробуйте позже.", reply_markup=ReplyKeyboardRemove())
             await message.answer("Главное меню:", reply_markup=main_menu())
             await state.clear()
             return
 
-    await message.answer("Заказ оформлен! Мы свяжемся с вами в ближайшее время.", reply_markup=ReplyKeyboardRemove())
+    await message.answer(f"Заказ №{order.id} оформлен! Мы свяжемся с вами в ближайшее время.", reply_markup=ReplyKeyboardRemove())
     await message.answer("Главное меню:", reply_markup=main_menu())
     await state.clear()
 
@@ -518,6 +619,37 @@ async def process_contact(message: types.Message, state: FSMContext, session: Se
         user.cart = []
         flag_modified(user, "cart")
 
+# Обработчик кнопки "Мои заказы" и перехода к следующей странице истории
+@dp.callback_query(F.data == "menu:orders")
+@dp.callback_query(F.data.startswith("orders:next:"))
+async def show_orders(callback: types.CallbackQuery, state: FSMContext, session: SessionType):
+    await callback.answer()
+    cursor = callback.data.split(":", 2)[2] if callback.data.startswith("orders:next:") else None
+    try:
+        orders, next_cursor = list_user_orders(session, callback.from_user.id, cursor=cursor)
+    except ValueError as e:
+        logging.warning(f"Malformed orders cursor from user {callback.from_user.id}: {e}. Showing first page.")
+        cursor = None
+        orders, next_cursor = list_user_orders(session, callback.from_user.id)
+
+    builder = InlineKeyboardBuilder()
+    if not orders:
+        text = "У вас пока нет заказов." if cursor is None else "Больше заказов нет."
+    else:
+        text = "📦 Ваши заказы:\n\n"
+        for order in orders:
+            text += f"Заказ №{order.id} от {order.created_at:%d.%m.%Y %H:%M}\n"
+            for line in order.lines:
+                text += f"    {line.name or f'Товар ID {line.product_id}'} - {line.quantity} шт.\n"
+            if order.discount:
+                text += f"    🎁 Скидка: -{order.discount} руб.\n"
+            text += f"    💵 Итого: {order.total} руб.\n\n"
+    if next_cursor:
+        builder.row(types.InlineKeyboardButton(text="Ранее ➡️", callback_data=f"orders:next:{next_cursor}"))
+    builder.row(types.InlineKeyboardButton(text="В главное меню", callback_data="menu:main"))
+    await edit_or_send_message(callback, text=text, reply_markup=builder.as_markup())
+    await state.set_state(UserState.MAIN_MENU)
+
 # Обработчик кнопки "Назад"
 @dp.callback_query(F.data.startswith("back:"))
 async def back_from_product(callback: types.CallbackQuery, state: FSMContext):
@@ -0,0 +1,184 @@
+# catalog_cache.py
+import json
+import logging
+import os
+import time
+
+from aiogram.types import InlineKeyboardMarkup
+
+from database import Product, get_catalog_fingerprint, get_catalog_version
+
+SNAPSHOT_FORMAT = 2
+# Как часто (в секундах) сверять закэшированные записи с версией и отпечатком каталога в БД
+VERSION_CHECK_INTERVAL = 30
+
+
+class ProductRecord:
+    """Легковесная копия строки Product, не привязанная к сессии."""
+
+    __slots__ = ("id", "sku", "name", "category", "subcategory", "price", "description", "image_path")
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_model(cls, product: Product):
+        return cls(**{name: getattr(product, name) for name in cls.__slots__})
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"<ProductRecord(id={self.id}, name='{self.name}')>"
+
+
+class CatalogCache:
+    """
+    Производное от каталога состояние: записи товаров, списки товаров по категориям,
+    готовые клавиатуры и file_id уже загруженных в Telegram фото.
+    Записи заполняются по мере обращения и сбрасываются, когда меняется версия каталога в БД
+    или его отпечаток (число товаров и суммы цен): так изменение цены в обход импорта
+    не попадет в заказ по устаревшей записи.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.fingerprint = None
+        self.products = {}
+        self.categories = {}
+        self.markups = {}
+        # image_path -> (file_id, mtime_ns, size); не зависит от версии каталога, но file_id привязан к боту
+        self.photos = {}
+        self._checked_at = 0.0
+
+    def _reset(self, version, fingerprint):
+        self.version = version
+        self.fingerprint = fingerprint
+        self.products.clear()
+        self.categories.clear()
+        self.markups.clear()
+
+    def ensure_fresh(self, session):
+        now = time.monotonic()
+        if self.version is not None and now - self._checked_at < VERSION_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        version = get_catalog_version(session)
+        # Список, а не кортеж: так отпечаток совпадает со значением, прочитанным из JSON-снимка
+        fingerprint = list(get_catalog_fingerprint(session))
+        if (version, fingerprint) != (self.version, self.fingerprint):
+            if self.version is not None:
+                logging.info(f"Catalog changed (version {self.version} -> {version}, "
+                             f"fingerprint {self.fingerprint} -> {fingerprint}), dropping cached catalog state.")
+            self._reset(version, fingerprint)
+
+    def get_product(self, session, product_id: int):
+        return self.get_products(session, [product_id]).get(product_id)
+
+    def get_products(self, session, product_ids) -> dict:
+        self.ensure_fresh(session)
+        missing = [product_id for product_id in product_ids if product_id not in self.products]
+        if missing:
+            # Отсутствующие товары не кэшируются: id приходит из callback data, и иначе кэш рос бы без ограничений
+            self.products.update(
+                (p.id, ProductRecord.from_model(p)) for p in session.query(Product).filter(Product.id.in_(missing))
+            )
+        return {product_id: self.products.get(product_id) for product_id in product_ids}
+
+    def products_in_category(self, session, category: str):
+        self.ensure_fresh(session)
+        if category not in self.categories:
+            products = session.query(Product).filter_by(category=category).order_by(Product.id).all()
+            for product in products:
+                self.products[product.id] = ProductRecord.from_model(product)
+            self.categories[category] = [product.id for product in products]
+        return [self.products[product_id] for product_id in self.categories[category]]
+
+    def markup(self, session, key: str, build):
+        """Возвращает готовую клавиатуру по ключу, при промахе строит ее через build()."""
+        self.ensure_fresh(session)
+        markup = self.markups.get(key)
+        if markup is None:
+            markup = self.markups[key] = build()
+        return markup
+
+    def photo_for(self, image_path: str):
+        """file_id ранее загруженного фото, если файл на диске с тех пор не менялся."""
+        cached = self.photos.get(image_path)
+        if cached is None:
+            return None
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        file_id, mtime_ns, size = cached
+        if (stat.st_mtime_ns, stat.st_size) != (mtime_ns, size):
+            del self.photos[image_path]
+            return None
+        return file_id
+
+    def remember_photo(self, image_path: str, file_id: str):
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return
+        self.photos[image_path] = (file_id, stat.st_mtime_ns, stat.st_size)
+
+    def forget_photo(self, image_path: str):
+        """Убирает file_id, который Telegram не принял: фото будет загружено заново."""
+        self.photos.pop(image_path, None)
+
+    def save(self, path: str, bot_id: int = None):
+        snapshot = {
+            "format": SNAPSHOT_FORMAT,
+            "bot_id": bot_id,
+            "catalog_version": self.version,
+            "catalog_fingerprint": self.fingerprint,
+            "products": [record.to_dict() for record in self.products.values()],
+            "categories": self.categories,
+            "markups": {key: markup.model_dump(mode="json", exclude_none=True) for key, markup in self.markups.items()},
+            "photos": self.photos,
+        }
+        # Запись во временный файл и атомарная замена: воркеры могут сохранять снимок одновременно
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        logging.info(f"Warm-start snapshot saved to {path}: {len(snapshot['products'])} products, "
+                     f"{len(self.markups)} markups, {len(self.photos)} photos.")
+
+    def load(self, path: str, bot_id: int = None) -> bool:
+        try:
+            with open(path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read warm-start snapshot {path}: {e}")
+            return False
+        if snapshot.get("format") != SNAPSHOT_FORMAT:
+            logging.warning(f"Ignoring warm-start snapshot {path} with unsupported format {snapshot.get('format')}.")
+            return False
+
+        self._reset(snapshot["catalog_version"], snapshot["catalog_fingerprint"])
+        for fields in snapshot["products"]:
+            self.products[fields["id"]] = ProductRecord(**fields)
+        self.categories = {category: ids for category, ids in snapshot["categories"].items()
+                           if all(product_id in self.products for product_id in ids)}
+        self.markups = {key: InlineKeyboardMarkup.model_validate(data) for key, data in snapshot["markups"].items()}
+        if snapshot.get("bot_id") == bot_id:
+            self.photos = {image_path: tuple(entry) for image_path, entry in snapshot["photos"].items()}
+        else:
+            # file_id действительны только для бота, который загрузил фото (например, сменился BOT_TOKEN)
+            logging.info(f"Warm-start snapshot {path} was saved by another bot, dropping cached photo file_ids.")
+            self.photos = {}
+        # Версия и отпечаток проверяются при первом же обращении к каталогу
+        self._checked_at = 0.0
+        logging.info(f"Warm-start snapshot loaded from {path} (catalog version {self.version}).")
+        return True
+
+
+catalog_cache = CatalogCache()
+
+__all__ = ["CatalogCache", "ProductRecord", "catalog_cache"]
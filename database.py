@@ -1,5 +1,6 @@
-from sqlalchemy import create_engine, Column, Integer, String, JSON, BigInteger
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import create_engine, Column, Integer, String, JSON, BigInteger, Boolean, DateTime, ForeignKey, Index, event, update, func
+from sqlalchemy.orm import sessionmaker, declarative_base, relationship
+from sqlalchemy.pool import StaticPool
 import os
 import contextlib # Импортируем contextlib
 
@@ -17,6 +18,8 @@ class User(Base):
 class Product(Base):
     __tablename__ = 'products'
     id = Column(Integer, primary_key=True)
+    # Артикул поставщика - естественный ключ для импорта каталога
+    sku = Column(String, unique=True, nullable=True)
     name = Column(String)
     category = Column(String)
     subcategory = Column(String)
@@ -24,15 +27,90 @@ class Product(Base):
     description = Column(String)
     image_path = Column(String)
 
+class CatalogVersion(Base):
+    __tablename__ = 'catalog_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=True)
+
+class Promotion(Base):
+    __tablename__ = 'promotions'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    # "bundle" (N+1) или "category_percent" (процент на категорию)
+    kind = Column(String, nullable=False)
+    # Цель правила: конкретный товар, категория или весь каталог (оба поля пустые)
+    product_id = Column(Integer, nullable=True)
+    category = Column(String, nullable=True)
+    buy_quantity = Column(Integer, default=0)
+    free_quantity = Column(Integer, default=0)
+    percent = Column(Integer, default=0)
+    # Окно действия акции (UTC), пустое значение - без ограничения
+    starts_at = Column(DateTime, nullable=True)
+    ends_at = Column(DateTime, nullable=True)
+    is_active = Column(Boolean, default=True)
+
+    def __repr__(self):
+        return f"<Promotion(id={self.id}, name='{self.name}', kind='{self.kind}')>"
+
+class Order(Base):
+    __tablename__ = 'orders'
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    user_id = Column(BigInteger, nullable=False)
+    # update_id из Telegram - ключ идемпотентности при повторной доставке
+    update_id = Column(BigInteger, nullable=False, unique=True)
+    created_at = Column(DateTime, nullable=False)
+    address = Column(String)
+    phone = Column(String)
+    subtotal = Column(Integer, nullable=False)
+    discount = Column(Integer, nullable=False, default=0)
+    total = Column(Integer, nullable=False)
+    lines = relationship("OrderLine", back_populates="order", cascade="all, delete-orphan", order_by="OrderLine.id")
+
+    # Keyset-пагинация истории заказов пользователя
+    __table_args__ = (Index('ix_orders_user_id_created_at', 'user_id', 'created_at', 'id'),)
+
+    def __repr__(self):
+        return f"<Order(id={self.id}, user_id={self.user_id}, total={self.total})>"
+
+class OrderLine(Base):
+    __tablename__ = 'order_lines'
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    order_id = Column(BigInteger, ForeignKey('orders.id', ondelete='CASCADE'), nullable=False, index=True)
+    # Снимок товара и цены на момент оформления заказа
+    product_id = Column(Integer)
+    name = Column(String)
+    quantity = Column(Integer, nullable=False)
+    unit_price = Column(Integer)
+    subtotal = Column(Integer, nullable=False, default=0)
+    discount = Column(Integer, nullable=False, default=0)
+    promotion_name = Column(String, nullable=True)
+    order = relationship("Order", back_populates="lines")
+
 # Database setup
 db_url = os.getenv("DATABASE_URL")
-if db_url:
+if db_url == "sqlite://":
+    # БД в памяти (например, для memory_soak.py): одно соединение на весь процесс, иначе у каждого своя пустая БД
+    engine = create_engine(db_url, poolclass=StaticPool, connect_args={"check_same_thread": False})
+elif db_url:
     engine = create_engine(db_url)
 else:
     BASE_DIR = os.path.dirname(os.path.abspath(__file__))
     DB_PATH = os.path.join(BASE_DIR, "bot.db")
     engine = create_engine(f"sqlite:///{DB_PATH}")
 
+if engine.dialect.name == "sqlite":
+    # pysqlite не открывает транзакцию до первой записи, поэтому SAVEPOINT (begin_nested)
+    # фиксировался сразу при RELEASE, и session.rollback() его не отменял.
+    # Рецепт SQLAlchemy: отключаем встроенное управление транзакциями драйвера и шлем BEGIN сами.
+    @event.listens_for(engine, "connect")
+    def _sqlite_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def _sqlite_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
 Base.metadata.create_all(engine)
 
 # Define SessionLocal as a factory for sessions
@@ -53,4 +131,40 @@ def get_session():
     try:
         yield session
     finally:
-        session.close()
\ No newline at end of file
+        session.close()
+
+def get_catalog_version(session) -> int:
+    """Returns the current catalog version (0 if the catalog was never imported)."""
+    row = session.get(CatalogVersion, 1)
+    return row.version if row else 0
+
+def get_catalog_fingerprint(session) -> tuple:
+    """
+    Cheap aggregate over the products table (row count, max id, price sums).
+    Catches added, removed and repriced products even when the writer did not
+    call bump_catalog_version.
+    """
+    row = session.query(
+        func.count(Product.id),
+        func.max(Product.id),
+        func.sum(Product.price),
+        func.sum(Product.price * Product.id),
+    ).one()
+    return tuple(int(value or 0) for value in row)
+
+def bump_catalog_version(session) -> int:
+    """
+    Increments the catalog version so that caches built from the catalog
+    are refreshed. Runs in the caller's transaction.
+    Call it on every write to the products table: changes to names, descriptions,
+    categories or images are only picked up by caches through the version.
+    """
+    updated = session.execute(
+        update(CatalogVersion)
+        .where(CatalogVersion.id == 1)
+        .values(version=CatalogVersion.version + 1, updated_at=func.now())
+    )
+    if updated.rowcount == 0:
+        session.add(CatalogVersion(id=1, version=1, updated_at=func.now()))
+        session.flush()
+    return get_catalog_version(session)
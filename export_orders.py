@@ -0,0 +1,23 @@
+import csv
+import sys
+
+from database import get_session
+from orders import iter_orders
+
+# Выгрузка всех заказов в CSV (по строке на позицию заказа): python export_orders.py > orders.csv
+FIELDS = [
+    "order_id", "created_at", "user_id", "address", "phone",
+    "product_id", "name", "quantity", "unit_price", "subtotal", "discount", "promotion_name", "order_total",
+]
+
+if __name__ == "__main__":
+    writer = csv.writer(sys.stdout)
+    writer.writerow(FIELDS)
+    with get_session() as session:
+        for order in iter_orders(session):
+            for line in order.lines:
+                writer.writerow([
+                    order.id, order.created_at.isoformat(), order.user_id, order.address, order.phone,
+                    line.product_id, line.name, line.quantity, line.unit_price, line.subtotal,
+                    line.discount, line.promotion_name, order.total,
+                ])
@@ -1,55 +1,33 @@
-from database import Product, get_session
+import os
 
-products = [
-    {
-        "name": "Корм для активных кошек",
-        "category": "cats",
-        "subcategory": "active",
-        "price": 1200,
-        "description": "Полнорационный корм для активных кошек. Содержит витамины и минералы.",
-        "image_path": "cat_active.jpg"
-    },
-    {
-        "name": "Корм для стерилизованных кошек",
-        "category": "cats",
-        "subcategory": "sterilized",
-        "price": 1300,
-        "description": "Корм для стерилизованных кошек. Поддерживает здоровье мочевыводящих путей.",
-        "image_path": "cat_sterilized.jpg"
-    },
-    {
-        "name": "Корм для мелких пород собак",
-        "category": "dogs",
-        "subcategory": "small",
-        "price": 1100,
-        "description": "Корм для мелких пород собак. Легкоусвояемый и вкусный.",
-        "image_path": "dog_small.jpg"
-    },
-    {
-        "name": "Корм для крупных и средних пород собак",
-        "category": "dogs",
-        "subcategory": "big",
-        "price": 1500,
-        "description": "Корм для крупных и средних пород собак. Содержит глюкозамин для суставов.",
-        "image_path": "dog_big.jpg"
-    },
+from database import Product, Promotion, get_session
+from import_catalog import import_catalog, read_rows
+
+# Базовый каталог магазина, загружается тем же импортером, что и файлы поставщиков
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog", "products.jsonl")
+
+promotions = [
     {
-        "name": "Корм для средних и крупных пород собак",
-        "category": "dogs",
-        "subcategory": "medium_big",
-        "price": 1400,
-        "description": "Корм для средних и крупных пород собак. Баланс белков и жиров.",
-        "image_path": "dog_medium_big.jpg"
+        "name": "Возьмите 10 пачек и одну получите бонусом",
+        "kind": "bundle",
+        "buy_quantity": 10,
+        "free_quantity": 1,
     }
 ]
 
 with get_session() as session:
-    for prod in products:
-        exists = session.query(Product).filter_by(
-            name=prod["name"], category=prod["category"], subcategory=prod["subcategory"]
-        ).first()
-        if not exists:
-            product = Product(**prod)
-            session.add(product)
+    # Товары, добавленные до появления артикулов, получают sku, чтобы импорт их обновил, а не продублировал
+    for row in read_rows(CATALOG_PATH):
+        session.query(Product).filter_by(
+            sku=None, name=row["name"], category=row["category"], subcategory=row["subcategory"]
+        ).update({"sku": row["sku"]})
+    session.commit()
+
+print(import_catalog(CATALOG_PATH))
+
+with get_session() as session:
+    for promo in promotions:
+        if not session.query(Promotion).filter_by(name=promo["name"]).first():
+            session.add(Promotion(**promo))
     session.commit()
 print("Товары успешно добавлены!")
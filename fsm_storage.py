@@ -0,0 +1,127 @@
+# fsm_storage.py
+import logging
+import sys
+import time
+from collections import OrderedDict
+from copy import copy
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+
+class _Record:
+    # Компактная запись: без __dict__, пустые данные не хранятся
+    __slots__ = ("state", "data", "touched")
+
+    def __init__(self, touched: float):
+        self.state = None
+        self.data = None
+        self.touched = touched
+
+
+class BoundedMemoryStorage(BaseStorage):
+    """
+    FSM-хранилище в памяти с ограниченным числом записей.
+    Записи хранятся в порядке LRU: запись, неактивная дольше idle_ttl секунд, вытесняется,
+    а при достижении max_entries вытесняется самая давно использованная.
+    В отличие от MemoryStorage, чтение состояния неизвестного пользователя не создает запись,
+    а запись с пустыми состоянием и данными сразу удаляется.
+    """
+
+    def __init__(self, max_entries: int = 100_000, idle_ttl: float = 24 * 60 * 60):
+        if max_entries < 1:
+            raise ValueError("max_entries must be >= 1")
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.records = OrderedDict()
+        self.evicted_lru = 0
+        self.evicted_ttl = 0
+
+    @staticmethod
+    def _key(key: StorageKey):
+        return (key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny)
+
+    def _expire(self, now: float):
+        # Самые давно неактивные записи всегда в начале OrderedDict
+        deadline = now - self.idle_ttl
+        records = self.records
+        while records:
+            compact_key, record = next(iter(records.items()))
+            if record.touched > deadline:
+                break
+            del records[compact_key]
+            self.evicted_ttl += 1
+
+    def _get(self, key: StorageKey):
+        now = time.monotonic()
+        self._expire(now)
+        compact_key = self._key(key)
+        record = self.records.get(compact_key)
+        if record is not None:
+            record.touched = now
+            self.records.move_to_end(compact_key)
+        return compact_key, record
+
+    def _get_or_create(self, key: StorageKey):
+        compact_key, record = self._get(key)
+        if record is None:
+            while len(self.records) >= self.max_entries:
+                self.records.popitem(last=False)
+                self.evicted_lru += 1
+            record = self.records[compact_key] = _Record(time.monotonic())
+        return compact_key, record
+
+    def _drop_if_empty(self, compact_key, record: _Record):
+        if record.state is None and not record.data:
+            self.records.pop(compact_key, None)
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        state = state.state if isinstance(state, State) else state
+        if state is None:
+            compact_key, record = self._get(key)
+            if record is None:
+                return
+        else:
+            compact_key, record = self._get_or_create(key)
+            state = sys.intern(state)
+        record.state = state
+        self._drop_if_empty(compact_key, record)
+
+    async def get_state(self, key: StorageKey):
+        _, record = self._get(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        if not data:
+            compact_key, record = self._get(key)
+            if record is None:
+                return
+        else:
+            compact_key, record = self._get_or_create(key)
+        record.data = data.copy() if data else None
+        self._drop_if_empty(compact_key, record)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        _, record = self._get(key)
+        return record.data.copy() if record and record.data else {}
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default=None):
+        _, record = self._get(storage_key)
+        if record is None or not record.data:
+            return default
+        return copy(record.data.get(dict_key, default))
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.records),
+            "max_entries": self.max_entries,
+            "evicted_lru": self.evicted_lru,
+            "evicted_ttl": self.evicted_ttl,
+        }
+
+    async def close(self) -> None:
+        # Записи не очищаем: хук закрытия срабатывает раньше, чем дообработаются текущие обновления
+        logging.info(f"FSM storage stats on shutdown: {self.stats()}")
+
+
+__all__ = ["BoundedMemoryStorage"]
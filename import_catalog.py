@@ -0,0 +1,179 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+
+from sqlalchemy import insert, update
+
+from database import Product, bump_catalog_version, get_session
+
+# Потоковый импорт каталога поставщика (CSV или JSONL) с upsert по артикулу (sku).
+# Пример: python import_catalog.py supplier.csv --chunk-size 5000 --resumable
+
+CHUNK_SIZE = 2000
+PRODUCT_FIELDS = ("name", "category", "subcategory", "price", "description", "image_path")
+# Без этих полей товар не может быть создан и не может потерять их при обновлении
+REQUIRED_FIELDS = ("name", "price")
+
+
+class ImportStats:
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.skipped = 0
+
+    def __str__(self):
+        return f"inserted={self.inserted} updated={self.updated} unchanged={self.unchanged} skipped={self.skipped}"
+
+
+def read_rows(path: str, file_format: str = None):
+    """Построчно читает файл поставщика, не загружая его в память целиком."""
+    file_format = file_format or ("jsonl" if path.endswith((".jsonl", ".ndjson")) else "csv")
+    with open(path, encoding="utf-8", newline="") as f:
+        if file_format == "csv":
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def normalize_row(row: dict):
+    """
+    Берет только поля, которые есть в строке (или в заголовке CSV): отсутствующие
+    колонки не затирают значения в БД. Возвращает None для некорректной строки.
+    """
+    sku = str(row.get("sku") or "").strip()
+    if not sku:
+        return None
+    record = {"sku": sku}
+    for field in PRODUCT_FIELDS:
+        if field in row:
+            value = row[field]
+            record[field] = value if value != "" else None
+    if record.get("price") is not None:
+        try:
+            record["price"] = int(record["price"])
+        except (TypeError, ValueError):
+            return None
+    if any(field in record and record[field] is None for field in REQUIRED_FIELDS):
+        return None
+    return record
+
+
+def chunked(rows, size: int):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def upsert_chunk(session, rows: list, stats: ImportStats):
+    """
+    Один SELECT по артикулам пачки, затем пакетные INSERT и UPDATE.
+    Строки без изменений не пишутся.
+    """
+    records = {}
+    for row in rows:
+        record = normalize_row(row)
+        if record is None:
+            stats.skipped += 1
+            continue
+        # При повторе артикула внутри пачки побеждает последняя строка
+        records[record["sku"]] = record
+
+    existing = {
+        product.sku: product
+        for product in session.query(Product.id, Product.sku, *[getattr(Product, field) for field in PRODUCT_FIELDS])
+        .filter(Product.sku.in_(records.keys()))
+    }
+    to_insert, to_update = [], []
+    for sku, record in records.items():
+        current = existing.get(sku)
+        if current is None:
+            if not all(field in record for field in REQUIRED_FIELDS):
+                stats.skipped += 1
+                continue
+            to_insert.append(record)
+        elif any(getattr(current, field) != record[field] for field in PRODUCT_FIELDS if field in record):
+            to_update.append({"id": current.id, **record})
+        else:
+            stats.unchanged += 1
+
+    if to_insert:
+        session.execute(insert(Product), to_insert)
+    if to_update:
+        session.execute(update(Product), to_update)
+    stats.inserted += len(to_insert)
+    stats.updated += len(to_update)
+
+
+def _read_checkpoint(path: str) -> int:
+    try:
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def _write_checkpoint(path: str, rows_done: int):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(str(rows_done))
+    os.replace(tmp_path, path)
+
+
+def import_catalog(path: str, chunk_size: int = CHUNK_SIZE, resumable: bool = False, file_format: str = None) -> ImportStats:
+    """
+    По умолчанию весь импорт выполняется в одной транзакции. В режиме resumable
+    каждая пачка фиксируется отдельно, а номер последней обработанной строки
+    сохраняется в <path>.checkpoint, чтобы прерванный импорт можно было продолжить.
+    """
+    stats = ImportStats()
+    checkpoint_path = f"{path}.checkpoint"
+    rows_done = _read_checkpoint(checkpoint_path) if resumable else 0
+    if rows_done:
+        logging.info(f"Resuming import of {path} after row {rows_done}.")
+
+    rows = read_rows(path, file_format)
+    for _ in range(rows_done):
+        next(rows, None)
+
+    with get_session() as session:
+        for chunk in chunked(rows, chunk_size):
+            upsert_chunk(session, chunk, stats)
+            rows_done += len(chunk)
+            if resumable:
+                session.commit()
+                _write_checkpoint(checkpoint_path, rows_done)
+            logging.info(f"Processed {rows_done} rows: {stats}")
+        version = bump_catalog_version(session)
+        session.commit()
+
+    if resumable and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    logging.info(f"Catalog import finished, catalog version {version}: {stats}")
+    return stats
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Import a supplier catalog (CSV or JSONL) keyed by SKU.")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=("csv", "jsonl"), default=None)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--resumable", action="store_true", help="commit every chunk and resume from a checkpoint")
+    args = parser.parse_args()
+    try:
+        result = import_catalog(args.path, chunk_size=args.chunk_size, resumable=args.resumable, file_format=args.format)
+    except Exception as e:
+        logging.critical(f"Catalog import failed: {e}", exc_info=True)
+        sys.exit(1)
+    print(result)
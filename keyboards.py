@@ -1,13 +1,17 @@
 # keyboards.py
+from functools import lru_cache
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 
+# Клавиатура статична, поэтому строится один раз
+@lru_cache(maxsize=None)
 def main_menu():
     builder = InlineKeyboardBuilder()
     builder.add(
         InlineKeyboardButton(text="Выбрать корм", callback_data="menu:feed_type"),
         InlineKeyboardButton(text="Акции", callback_data="menu:promo"),
         InlineKeyboardButton(text="Корзина", callback_data="menu:cart"),
+        InlineKeyboardButton(text="Мои заказы", callback_data="menu:orders"),
         InlineKeyboardButton(text="Помощь", callback_data="menu:help"),
     )
     builder.adjust(2)
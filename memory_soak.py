@@ -0,0 +1,149 @@
+import argparse
+import asyncio
+import gc
+import itertools
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+# Проверка памяти: прогоняет через dp.feed_update поток синтетических пользователей
+# и проверяет, что после заполнения бюджета FSM потребление памяти не растет.
+# Запуск: BOT_TOKEN=1:x python memory_soak.py --users 1000000 --max-entries 10000
+# Каждый синтетический пользователь получает строку в таблице users. По умолчанию прогон идет на БД SQLite
+# в памяти (DATABASE_URL=sqlite://), каталог загружается из catalog/products.jsonl. Чтобы проверить на
+# дисковой БД, задайте DATABASE_URL явно; пустой каталог в ней тоже будет загружен.
+# По умолчанию рост считается в блоках аллокатора Python (sys.getallocatedblocks) - это почти бесплатно,
+# и миллион пользователей на одном ядре проходит примерно за 3.5 часа. --tracemalloc считает байты точно,
+# но замедляет прогон в несколько раз; его стоит запускать на меньшем числе пользователей.
+
+MB = 1024 * 1024
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog", "products.jsonl")
+
+
+def _callback_update(update_id: int, user_id: int, data: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": "Soak"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {"message_id": 1, "date": 0, "chat": {"id": user_id, "type": "private"}, "text": "Главное меню:"},
+        },
+    }
+
+
+def _message_update(update_id: int, user_id: int, **content) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": "Soak"}
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "chat": {"id": user_id, "type": "private"}, "from": user, **content},
+    }
+
+
+def _user_updates(user_id: int, product_id: int):
+    """
+    Сценарий одного пользователя. Кроме переходов по меню он доходит до ввода адреса
+    (данные FSM через update_data). Половина пользователей бросает оформление, и их записи
+    вытесняются вместе с данными; остальные очищают корзину и отправляют контакт:
+    оформление прерывается через state.clear(), и запись FSM без данных удаляется.
+    """
+    yield _callback_update, {"data": "menu:feed_type"}
+    yield _callback_update, {"data": "menu:help"}
+    yield _callback_update, {"data": f"cart:add:{product_id}"}
+    yield _callback_update, {"data": "cart:checkout"}
+    yield _message_update, {"text": f"Soak street, {user_id}"}
+    if user_id % 2:
+        return
+    yield _callback_update, {"data": "cart:clear"}
+    yield _message_update, {"contact": {"phone_number": f"+7{user_id:010d}", "first_name": "Soak", "user_id": user_id}}
+
+
+def _meter(traced: bool):
+    """Функция замера памяти и форматирование ее значений."""
+    if traced:
+        tracemalloc.start()
+        return lambda: tracemalloc.get_traced_memory()[0], lambda value, sign="": f"{value / MB:{sign}.2f} MB"
+    # Число выделенных блоков аллокатора Python: почти бесплатно, в отличие от tracemalloc,
+    # и каждый утекший объект добавляет хотя бы один блок
+    return sys.getallocatedblocks, lambda value, sign="": f"{value:{sign}d} blocks"
+
+
+async def soak(users: int, warmup: int, tolerance: float, traced: bool, concurrency: int = 1) -> bool:
+    import bot as bot_module
+    from aiogram import Bot
+    from aiogram.types import Update
+    from database import Product, get_session
+    from import_catalog import import_catalog
+    from offline_session import OfflineSession
+
+    logging.getLogger().setLevel(logging.ERROR)
+    dp = bot_module.dp
+    bot = Bot(token=bot_module.BOT_TOKEN, session=OfflineSession())
+    with get_session() as session:
+        product = session.query(Product.id).order_by(Product.id).first()
+    if product is None:
+        import_catalog(CATALOG_PATH)
+        with get_session() as session:
+            product = session.query(Product.id).order_by(Product.id).first()
+
+    progress_every = max(users // 10, 1)
+    measure, fmt = _meter(traced)
+    baseline = None
+    started = time.perf_counter()
+    update_ids = itertools.count(1)
+
+    async def play(user_id: int):
+        for build, content in _user_updates(user_id, product.id):
+            update = Update.model_validate(build(next(update_ids), user_id, **content), context={"bot": bot})
+            await dp.feed_update(bot, update)
+
+    done = 0
+    while done < users:
+        first, done = done + 1, min(done + concurrency, users)
+        # Обновления одного пользователя идут по порядку, разные пользователи - параллельно, как в боевом режиме:
+        # синхронные фильтры aiogram выполняются в потоках, и последовательный прогон в основном ждал бы их
+        await asyncio.gather(*(play(user_id) for user_id in range(first, done + 1)))
+        if baseline is None and done >= warmup:
+            gc.collect()
+            baseline = measure()
+            print(f"baseline after {done} users: {fmt(baseline)}, storage {dp.storage.stats()}")
+        elif baseline is not None and done // progress_every > (first - 1) // progress_every:
+            current = measure()
+            print(f"{done} users: {fmt(current)} ({fmt(current - baseline, '+')}), "
+                  f"{done / (time.perf_counter() - started):.0f} users/s")
+
+    gc.collect()
+    current = measure()
+    if traced:
+        tracemalloc.stop()
+    await bot.session.close()
+    growth = current - baseline
+    print(f"final after {users} users: {fmt(current)} ({fmt(growth, '+')}), storage {dp.storage.stats()}")
+    return growth <= tolerance
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay synthetic users through the dispatcher and check that memory stays flat.")
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--max-entries", type=int, default=10_000, help="FSM memory budget (records)")
+    parser.add_argument("--concurrency", type=int, default=100, help="users replayed in parallel")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="measure traced bytes instead of allocator blocks (several times slower)")
+    # Допуски покрывают разовый рост внутренних таблиц интерпретатора (например, таблицы интернированных строк);
+    # утечка даже одного объекта (или нескольких байт) на пользователя на миллионе пользователей их превысит
+    parser.add_argument("--tolerance-blocks", type=int, default=50_000, help="allowed growth after warm-up")
+    parser.add_argument("--tolerance-mb", type=float, default=4.0, help="allowed growth after warm-up with --tracemalloc")
+    args = parser.parse_args()
+    os.environ["FSM_MAX_ENTRIES"] = str(args.max_entries)
+    os.environ.setdefault("DATABASE_URL", "sqlite://")
+    # Прогрев: бюджет FSM заполнен с запасом, дальше память должна быть плоской
+    warmup = min(args.users // 2, args.max_entries * 2)
+    tolerance = args.tolerance_mb * MB if args.tracemalloc else args.tolerance_blocks
+    if not asyncio.run(soak(args.users, warmup, tolerance, args.tracemalloc, args.concurrency)):
+        print("FAIL: memory grew beyond tolerance")
+        sys.exit(1)
+    print("OK: memory stayed flat")
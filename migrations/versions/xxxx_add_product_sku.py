@@ -0,0 +1,12 @@
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('products', sa.Column('sku', sa.String(), nullable=True))
+    op.create_unique_constraint('uq_products_sku', 'products', ['sku'])
+
+
+def downgrade():
+    op.drop_constraint('uq_products_sku', 'products', type_='unique')
+    op.drop_column('products', 'sku')
@@ -0,0 +1,23 @@
+# offline_session.py
+from aiogram.client.session.base import BaseSession
+
+
+class OfflineSession(BaseSession):
+    """
+    Сессия Bot API без сети: на любой запрос отвечает True.
+    Используется бенчмарком и проверкой памяти, чтобы мерить только работу обработчиков.
+    """
+
+    async def make_request(self, bot, method, timeout=None):
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        # Скачивать нечего: пустой поток
+        return
+        yield
+
+    async def close(self):
+        pass
+
+
+__all__ = ["OfflineSession"]
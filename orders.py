@@ -0,0 +1,114 @@
+# orders.py
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+
+from database import Order, OrderLine
+from promotions import utcnow
+
+ORDERS_PAGE_SIZE = 5
+EXPORT_BATCH_SIZE = 1000
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def create_order(session, update_id: int, user_id: int, cart: list, pricing, address: str, phone: str):
+    """
+    Сохраняет заказ со снимком цен. Повторная доставка того же update_id
+    возвращает уже созданный заказ. Возвращает (order, created).
+    """
+    existing = session.query(Order).filter_by(update_id=update_id).first()
+    if existing:
+        logging.info(f"Order for update {update_id} already exists (ID: {existing.id}), skipping.")
+        return existing, False
+
+    order = Order(
+        user_id=user_id,
+        update_id=update_id,
+        created_at=utcnow(),
+        address=address,
+        phone=phone,
+        subtotal=pricing.subtotal,
+        discount=pricing.discount,
+        total=pricing.total,
+    )
+    # Строки пишутся одним пакетным INSERT при flush
+    order.lines = [
+        OrderLine(
+            product_id=cart[line.index]["product_id"],
+            name=line.product.name if line.product else None,
+            quantity=line.quantity,
+            unit_price=line.product.price if line.product else None,
+            subtotal=line.subtotal,
+            discount=line.discount,
+            promotion_name=line.rule_name,
+        )
+        for line in pricing.lines
+    ]
+    try:
+        with session.begin_nested():
+            session.add(order)
+    except IntegrityError:
+        # Параллельная доставка того же update успела записать заказ раньше
+        logging.info(f"Concurrent insert for update {update_id}, reusing existing order.")
+        return session.query(Order).filter_by(update_id=update_id).one(), False
+    return order, True
+
+
+def encode_cursor(order: Order) -> str:
+    micros = (order.created_at - _EPOCH) // timedelta(microseconds=1)
+    return f"{micros}:{order.id}"
+
+
+def decode_cursor(cursor: str):
+    """Разбирает курсор страницы; на некорректные данные бросает ValueError."""
+    try:
+        micros, order_id = cursor.split(":")
+        return _EPOCH + timedelta(microseconds=int(micros)), int(order_id)
+    except (ValueError, OverflowError) as e:
+        raise ValueError(f"invalid orders cursor '{cursor}'") from e
+
+
+def list_user_orders(session, user_id: int, cursor: str = None, limit: int = ORDERS_PAGE_SIZE):
+    """
+    Страница заказов пользователя, от новых к старым, по индексу
+    (user_id, created_at, id). Возвращает (orders, next_cursor).
+    """
+    query = session.query(Order).options(selectinload(Order.lines)).filter(Order.user_id == user_id)
+    if cursor:
+        query = query.filter(tuple_(Order.created_at, Order.id) < decode_cursor(cursor))
+    orders = query.order_by(Order.created_at.desc(), Order.id.desc()).limit(limit + 1).all()
+    if len(orders) > limit:
+        return orders[:limit], encode_cursor(orders[limit - 1])
+    return orders, None
+
+
+def iter_orders(session, batch_size: int = EXPORT_BATCH_SIZE):
+    """Потоковый обход всех заказов пачками по первичному ключу."""
+    last_id = 0
+    while True:
+        batch = (
+            session.query(Order)
+            .options(selectinload(Order.lines))
+            .filter(Order.id > last_id)
+            .order_by(Order.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            return
+        yield from batch
+        last_id = batch[-1].id
+        # Освобождаем identity map, чтобы память не росла на больших выгрузках
+        session.expunge_all()
+
+
+__all__ = [
+    "ORDERS_PAGE_SIZE",
+    "create_order",
+    "iter_orders",
+    "list_user_orders",
+]
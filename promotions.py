@@ -0,0 +1,199 @@
+# promotions.py
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from database import Promotion
+
+KIND_BUNDLE = "bundle"
+KIND_CATEGORY_PERCENT = "category_percent"
+
+
+def utcnow():
+    # Окна акций хранятся в БД как naive UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+@dataclass(frozen=True)
+class CompiledRule:
+    id: int
+    name: str
+    kind: str
+    buy_quantity: int
+    free_quantity: int
+    percent: int
+    starts_at: datetime | None
+    ends_at: datetime | None
+
+    def is_live(self, now: datetime) -> bool:
+        if self.starts_at and now < self.starts_at:
+            return False
+        if self.ends_at and now >= self.ends_at:
+            return False
+        return True
+
+    def discount(self, price: int, quantity: int) -> int:
+        if self.kind == KIND_BUNDLE:
+            # Из каждой группы buy+free единиц free единиц бесплатно
+            group = self.buy_quantity + self.free_quantity
+            return (quantity // group) * self.free_quantity * price
+        if self.kind == KIND_CATEGORY_PERCENT:
+            return price * quantity * self.percent // 100
+        return 0
+
+
+@dataclass
+class PricedLine:
+    index: int
+    product: object
+    quantity: int
+    subtotal: int = 0
+    discount: int = 0
+    rule_name: str | None = None
+
+    @property
+    def total(self) -> int:
+        return self.subtotal - self.discount
+
+
+@dataclass
+class CartPricing:
+    lines: list
+    subtotal: int = 0
+    discount: int = 0
+
+    @property
+    def total(self) -> int:
+        return self.subtotal - self.discount
+
+
+class PromotionPlan:
+    """
+    Скомпилированный набор правил, проиндексированный по товару и категории.
+    Стоимость оценки корзины зависит только от числа строк корзины
+    и правил, относящихся к конкретной строке, а не от общего числа акций.
+    """
+
+    def __init__(self, rules):
+        by_product = {}
+        by_category = {}
+        global_rules = []
+        for promotion, rule in rules:
+            if promotion.product_id is not None:
+                by_product.setdefault(promotion.product_id, []).append(rule)
+            elif promotion.category:
+                by_category.setdefault(promotion.category, []).append(rule)
+            else:
+                global_rules.append(rule)
+        self.by_product = {key: tuple(value) for key, value in by_product.items()}
+        self.by_category = {key: tuple(value) for key, value in by_category.items()}
+        self.global_rules = tuple(global_rules)
+        self.rules = tuple(rule for _, rule in rules)
+
+    def live_rules(self, now: datetime = None):
+        now = now or utcnow()
+        return [rule for rule in self.rules if rule.is_live(now)]
+
+    def evaluate(self, lines, now: datetime = None) -> CartPricing:
+        """
+        Один проход по строкам корзины. lines - пары (product, quantity),
+        product может быть None для товаров, отсутствующих в каталоге.
+        Акции не суммируются: к строке применяется самая выгодная.
+        """
+        now = now or utcnow()
+        pricing = CartPricing(lines=[])
+        for index, (product, quantity) in enumerate(lines):
+            line = PricedLine(index=index, product=product, quantity=quantity)
+            pricing.lines.append(line)
+            if product is None:
+                continue
+            line.subtotal = product.price * quantity
+            for rule in (
+                self.by_product.get(product.id, ())
+                + self.by_category.get(product.category, ())
+                + self.global_rules
+            ):
+                if not rule.is_live(now):
+                    continue
+                discount = min(rule.discount(product.price, quantity), line.subtotal)
+                if discount > line.discount:
+                    line.discount = discount
+                    line.rule_name = rule.name
+            pricing.subtotal += line.subtotal
+            pricing.discount += line.discount
+        return pricing
+
+
+def _compile_rule(promotion: Promotion):
+    if promotion.kind == KIND_BUNDLE:
+        if not promotion.buy_quantity or not promotion.free_quantity:
+            raise ValueError("bundle promotion needs buy_quantity and free_quantity")
+    elif promotion.kind == KIND_CATEGORY_PERCENT:
+        if not 0 < (promotion.percent or 0) <= 100:
+            raise ValueError("percent must be in range 1..100")
+    else:
+        raise ValueError(f"unknown promotion kind '{promotion.kind}'")
+    return CompiledRule(
+        id=promotion.id,
+        name=promotion.name,
+        kind=promotion.kind,
+        buy_quantity=promotion.buy_quantity or 0,
+        free_quantity=promotion.free_quantity or 0,
+        percent=promotion.percent or 0,
+        starts_at=promotion.starts_at,
+        ends_at=promotion.ends_at,
+    )
+
+
+def compile_plan(promotions) -> PromotionPlan:
+    rules = []
+    for promotion in promotions:
+        try:
+            rules.append((promotion, _compile_rule(promotion)))
+        except ValueError as e:
+            logging.error(f"Skipping invalid promotion {promotion!r}: {e}")
+    return PromotionPlan(rules)
+
+
+# Как часто (в секундах) перечитывать акции из БД: выключение акции или новая кампания
+# подхватываются всеми процессами без перезапуска
+REFRESH_INTERVAL = 30
+
+# План компилируется заново, только если набор активных правил в БД изменился
+_plan = None
+_fingerprint = None
+_checked_at = 0.0
+
+
+def _promotion_fingerprint(promotions):
+    return tuple(
+        (p.id, p.name, p.kind, p.product_id, p.category, p.buy_quantity, p.free_quantity, p.percent, p.starts_at, p.ends_at)
+        for p in promotions
+    )
+
+
+def get_promotion_plan(session) -> PromotionPlan:
+    global _plan, _fingerprint, _checked_at
+    now = time.monotonic()
+    if _plan is not None and now - _checked_at < REFRESH_INTERVAL:
+        return _plan
+    _checked_at = now
+    promotions = session.query(Promotion).filter_by(is_active=True).order_by(Promotion.id).all()
+    fingerprint = _promotion_fingerprint(promotions)
+    if fingerprint != _fingerprint:
+        _plan = compile_plan(promotions)
+        _fingerprint = fingerprint
+        logging.info(f"Promotion plan compiled: {len(_plan.rules)} active rules.")
+    return _plan
+
+
+__all__ = [
+    "KIND_BUNDLE",
+    "KIND_CATEGORY_PERCENT",
+    "CartPricing",
+    "PricedLine",
+    "PromotionPlan",
+    "compile_plan",
+    "get_promotion_plan",
+]
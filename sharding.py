@@ -0,0 +1,361 @@
+# sharding.py
+# Шардированный режим: процесс-супервизор забирает обновления через getUpdates и раздает их
+# N процессам-воркерам по chat id. Все обновления одного чата попадают в один воркер и
+# обрабатываются в порядке поступления, поэтому FSM-состояние в памяти воркера остается согласованным.
+#
+# Запуск:    python sharding.py --workers 4          (или BOT_WORKERS=4 python sharding.py)
+# Бенчмарк:  BOT_TOKEN=1:x python sharding.py --workers 4 --bench 20000
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+
+import aiohttp
+
+from offline_session import OfflineSession
+
+POLLING_TIMEOUT = 30
+# Элемент очереди шарда - пачка обновлений этого шарда из одного ответа getUpdates (до 100 штук):
+# одна сериализация и одна запись в pipe на пачку вместо каждого обновления
+QUEUE_SIZE = 1000
+BATCH_SIZE = 100
+# Размер пачки в бенчмарке, как у ответа getUpdates
+BENCH_CHUNK = 100
+# Сколько обновлений воркер обрабатывает одновременно; остальные ждут в очереди шарда
+MAX_IN_FLIGHT = 1000
+PUT_TIMEOUT = 1
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 60
+MONITOR_INTERVAL = 2
+SHUTDOWN_TIMEOUT = 30
+
+
+def shard_for(chat_id: int, workers: int) -> int:
+    return chat_id % workers
+
+
+def raw_chat_id(raw: dict) -> int:
+    """
+    chat id необработанного обновления Telegram (как в UserContextMiddleware, но без pydantic):
+    чат события или чат сообщения под callback-кнопкой, иначе id пользователя.
+    """
+    for key, event in raw.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+    return raw["update_id"]
+
+
+class ChatSerializer:
+    """
+    Обрабатывает обновления разных чатов конкурентно, а обновления одного чата -
+    строго по очереди.
+    """
+
+    def __init__(self):
+        self._tails = {}
+
+    def submit(self, chat_id: int, coro_factory):
+        previous = self._tails.get(chat_id)
+        task = asyncio.ensure_future(self._run(chat_id, previous, coro_factory))
+        self._tails[chat_id] = task
+        return task
+
+    async def _run(self, chat_id: int, previous, coro_factory):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await coro_factory()
+        except Exception as e:
+            logging.error(f"Update handling failed for chat {chat_id}: {e}", exc_info=True)
+        finally:
+            if self._tails.get(chat_id) is asyncio.current_task():
+                del self._tails[chat_id]
+
+    @property
+    def pending(self) -> int:
+        return len(self._tails)
+
+    async def drain(self):
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+
+async def _worker_loop(index: int, updates, heartbeat, processed, bench: bool):
+    import bot as bot_module
+    from aiogram import Bot
+    from aiogram.types import Update
+
+    bot = Bot(token=bot_module.BOT_TOKEN, session=OfflineSession()) if bench else bot_module.bot
+    dp = bot_module.dp
+    loop = asyncio.get_running_loop()
+    serializer = ChatSerializer()
+    # Ограничение на число обрабатываемых обновлений: пока слоты заняты, воркер не забирает
+    # новые обновления из очереди, и переполнение очереди притормаживает супервизор
+    in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+
+    async def handle(update):
+        try:
+            await dp.feed_update(bot, update)
+            with processed.get_lock():
+                processed.value += 1
+        finally:
+            in_flight.release()
+
+    async def beat():
+        # Heartbeat подтверждает, что event loop воркера жив, даже когда все слоты заняты
+        while True:
+            heartbeat.value = time.time()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    # Воркер не вызывает start_polling, поэтому сам запускает хуки startup/shutdown (снимок кэша и т.п.)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    logging.info(f"Worker {index} started (pid {os.getpid()}).")
+    heartbeat_task = asyncio.ensure_future(beat())
+    running = True
+    while running:
+        try:
+            packs = [await loop.run_in_executor(None, updates.get, True, HEARTBEAT_INTERVAL)]
+        except queue.Empty:
+            continue
+        # Забираем накопившиеся пачки без лишних переключений в поток
+        while packs[-1] is not None and sum(len(pack) for pack in packs) < BATCH_SIZE:
+            try:
+                packs.append(updates.get_nowait())
+            except queue.Empty:
+                break
+        if packs[-1] is None:
+            packs.pop()
+            running = False
+        for chat_id, raw in (item for pack in packs for item in pack):
+            await in_flight.acquire()
+            try:
+                update = Update.model_validate(raw, context={"bot": bot})
+            except Exception as e:
+                in_flight.release()
+                logging.error(f"Dropping invalid update for chat {chat_id}: {e}")
+                continue
+            serializer.submit(chat_id, lambda update=update: handle(update))
+        # Даем обработчикам поработать, не дожидаясь следующей пачки
+        await asyncio.sleep(0)
+
+    await serializer.drain()
+    heartbeat_task.cancel()
+    await dp.emit_shutdown(bot=bot, dispatcher=dp)
+    await bot.session.close()
+    logging.info(f"Worker {index} stopped.")
+
+
+def _worker_main(index: int, updates, heartbeat, processed, bench: bool):
+    # Супервизор сам обрабатывает SIGINT/SIGTERM и останавливает воркеры через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_worker_loop(index, updates, heartbeat, processed, bench))
+
+
+class Supervisor:
+    def __init__(self, workers: int, bench: bool = False):
+        # spawn: каждый воркер создает собственные Bot, Dispatcher и event loop
+        self.ctx = multiprocessing.get_context("spawn")
+        self.workers = workers
+        self.bench = bench
+        self.queues = [self.ctx.Queue(QUEUE_SIZE) for _ in range(workers)]
+        self.heartbeats = [self.ctx.Value("d", 0.0) for _ in range(workers)]
+        self.processed = [self.ctx.Value("q", 0) for _ in range(workers)]
+        self.processes = [None] * workers
+        self.restarts = 0
+        self.stopping = False
+
+    def start_worker(self, index: int):
+        self.heartbeats[index].value = time.time() + HEARTBEAT_TIMEOUT  # запас на импорт бота
+        process = self.ctx.Process(
+            target=_worker_main,
+            args=(index, self.queues[index], self.heartbeats[index], self.processed[index], self.bench),
+            name=f"bot-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(self.workers):
+            self.start_worker(index)
+
+    def check_workers(self):
+        now = time.time()
+        for index, process in enumerate(self.processes):
+            if not process.is_alive():
+                logging.error(f"Worker {index} died with exit code {process.exitcode}, restarting.")
+            elif now - self.heartbeats[index].value > HEARTBEAT_TIMEOUT:
+                logging.error(f"Worker {index} missed heartbeats for {HEARTBEAT_TIMEOUT}s, restarting.")
+                process.kill()
+                process.join()
+            else:
+                continue
+            self.restarts += 1
+            # Убитый процесс мог удерживать блокировку чтения очереди, поэтому шард получает новую очередь.
+            # Обновления, не забранные упавшим воркером, теряются так же, как при перезапуске бота.
+            self.queues[index] = self.ctx.Queue(QUEUE_SIZE)
+            self.start_worker(index)
+
+    async def dispatch(self, items):
+        """items - пары (chat_id, raw) в порядке поступления; каждый шард получает их одной пачкой."""
+        packs = {}
+        for chat_id, raw in items:
+            packs.setdefault(shard_for(chat_id, self.workers), []).append((chat_id, raw))
+        for shard, pack in packs.items():
+            await self._put(shard, pack)
+
+    async def _put(self, shard: int, item):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Очередь берется заново на каждой попытке: монитор мог заменить ее, перезапустив зависший воркер
+            target = self.queues[shard]
+            try:
+                target.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            # Очередь воркера переполнена - притормаживаем получение обновлений
+            try:
+                await loop.run_in_executor(None, target.put, item, True, PUT_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    async def poll(self, bot, allowed_updates):
+        # getUpdates запрашивается напрямую: супервизор не разбирает обновления через pydantic,
+        # валидация выполняется в воркерах
+        url = bot.session.api.api_url(token=bot.token, method="getUpdates")
+        offset = None
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=POLLING_TIMEOUT + 10)) as http:
+            while not self.stopping:
+                payload = {"timeout": POLLING_TIMEOUT, "allowed_updates": allowed_updates}
+                if offset is not None:
+                    payload["offset"] = offset
+                try:
+                    async with http.post(url, json=payload) as response:
+                        body = await response.json()
+                    if not body.get("ok"):
+                        raise RuntimeError(body.get("description"))
+                except Exception as e:
+                    logging.error(f"Failed to fetch updates: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                results = body["result"]
+                if results:
+                    await self.dispatch([(raw_chat_id(raw), raw) for raw in results])
+                    offset = results[-1]["update_id"] + 1
+
+    async def monitor(self):
+        while not self.stopping:
+            self.check_workers()
+            await asyncio.sleep(MONITOR_INTERVAL)
+
+    def stop_workers(self, timeout: float = SHUTDOWN_TIMEOUT):
+        self.stopping = True
+        for index, updates in enumerate(self.queues):
+            try:
+                updates.put(None, timeout=PUT_TIMEOUT)
+            except queue.Full:
+                # Воркер не разбирает очередь - он будет принудительно остановлен после таймаута
+                logging.warning(f"Queue of worker {index} is full, stop signal not delivered.")
+        deadline = time.time() + timeout
+        for index, process in enumerate(self.processes):
+            process.join(max(0.0, deadline - time.time()))
+            if process.is_alive():
+                logging.warning(f"Worker {index} did not stop in time, terminating.")
+                process.terminate()
+                process.join()
+
+    def wait_ready(self):
+        # Воркер готов, когда обновил heartbeat после импорта бота
+        while any(hb.value > time.time() for hb in self.heartbeats):
+            time.sleep(0.05)
+
+    @property
+    def total_processed(self) -> int:
+        return sum(counter.value for counter in self.processed)
+
+
+async def run_supervisor(workers: int):
+    import bot as bot_module
+
+    supervisor = Supervisor(workers)
+    supervisor.start()
+    logging.info(f"Supervisor started {workers} workers.")
+
+    loop = asyncio.get_running_loop()
+    polling = asyncio.ensure_future(supervisor.poll(bot_module.bot, bot_module.dp.resolve_used_update_types()))
+    monitor = asyncio.ensure_future(supervisor.monitor())
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, polling.cancel)
+    try:
+        await polling
+    except asyncio.CancelledError:
+        logging.info("Supervisor received stop signal.")
+    finally:
+        monitor.cancel()
+        await loop.run_in_executor(None, supervisor.stop_workers)
+        await bot_module.bot.session.close()
+        logging.info(f"Supervisor stopped. Processed {supervisor.total_processed} updates, {supervisor.restarts} worker restarts.")
+
+
+def _bench_update(update_id: int, chat_id: int) -> dict:
+    user = {"id": chat_id, "is_bot": False, "first_name": "Bench"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": str(chat_id),
+            "data": "menu:feed_type",
+            "message": {"message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "Главное меню:"},
+        },
+    }
+
+
+async def run_bench(workers: int, total: int, chats: int = 1000):
+    supervisor = Supervisor(workers, bench=True)
+    supervisor.start()
+    supervisor.wait_ready()
+    chunks = []
+    for first in range(0, total, BENCH_CHUNK):
+        chunks.append([(update_id % chats + 1, _bench_update(update_id, update_id % chats + 1))
+                       for update_id in range(first, min(first + BENCH_CHUNK, total))])
+    started = time.perf_counter()
+    # Процессорное время супервизора (включая поток сериализации очередей): если его пропускная
+    # способность близка к общей, масштабирование упирается в супервизор, а не в воркеры
+    cpu_started = time.process_time()
+    for chunk in chunks:
+        await supervisor.dispatch(chunk)
+    await asyncio.get_running_loop().run_in_executor(None, supervisor.stop_workers, 600)
+    elapsed = time.perf_counter() - started
+    supervisor_cpu = time.process_time() - cpu_started
+    print(f"workers={workers} updates={supervisor.total_processed} elapsed={elapsed:.2f}s "
+          f"rate={supervisor.total_processed / elapsed:.0f} updates/s "
+          f"supervisor_capacity={total / max(supervisor_cpu, 1e-9):.0f} updates/s")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Run the bot as N worker processes sharded by chat id.")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("BOT_WORKERS", os.cpu_count() or 1)))
+    parser.add_argument("--bench", type=int, metavar="UPDATES", help="feed synthetic updates instead of polling Telegram")
+    args = parser.parse_args()
+    if args.workers < 1:
+        sys.exit("--workers must be >= 1")
+    if args.bench:
+        asyncio.run(run_bench(args.workers, args.bench))
+    else:
+        asyncio.run(run_supervisor(args.workers))